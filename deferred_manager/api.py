@@ -6,14 +6,19 @@ import webapp2
 from operator import itemgetter
 
 from google.appengine.api.logservice import logservice
-from google.appengine.api import taskqueue
+from google.appengine.api import datastore_errors, taskqueue
 from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
-from .models import TaskState, UniqueTaskMarker
+from . import cache, export, local, runstate
+from .handler import task_wrapper
+from .models import TaskState, TaskDependency, TaskProfile
 from .utils import get_queue_info
 from .wrapper import defer
 
+# number of tasks marked as purged by each task in a chain
+PURGE_BATCH_SIZE = 100
+
 
 def _serializer(obj):
     if isinstance(obj, datetime.datetime):
@@ -45,24 +50,24 @@ class QueueListHandler(webapp2.RequestHandler):
 class QueueHandler(webapp2.RequestHandler):
     def get(self, queue_name):
         cursor = self.request.GET.get('cursor')
-
-        if cursor:
-            cursor = Cursor(urlsafe=cursor)
-
         limit = int(self.request.GET.get('limit', 1000))
 
         if not limit:
             tasks = []
             new_cursor = more = None
         else:
-            tasks, new_cursor, more = (
-                TaskState
-                .query(TaskState.queue_name == queue_name)
-                .order(-TaskState.deferred_at)
-                .fetch_page(
-                    limit,
-                    start_cursor=cursor)
-            )
+            try:
+                tasks, new_cursor, more = TaskState.fetch_queue_page(
+                    queue_name, limit, cursor)
+            except datastore_errors.BadValueError:
+                # e.g. from before the number of shards was changed
+                self.response.set_status(400)
+                self.response.content_type = "application/json"
+                self.response.write(dump({
+                    "message": "Invalid cursor"
+                }))
+                return
+            runstate.merge(tasks)
 
         stats = self.get_queue_stats(queue_name)
         ctx = {}
@@ -76,7 +81,7 @@ class QueueHandler(webapp2.RequestHandler):
                 stats.oldest_eta_usec / 1e6)
         ctx['tasks'] = [t.to_dict() for t in tasks]
         if new_cursor:
-            ctx['cursor'] = new_cursor.urlsafe()
+            ctx['cursor'] = new_cursor
 
         self.response.content_type = "application/json"
         self.response.write(dump(ctx))
@@ -84,33 +89,8 @@ class QueueHandler(webapp2.RequestHandler):
     def delete(self, queue_name):
         self.get_queue_stats(queue_name).queue.purge()
 
-        @ndb.transactional_tasklet(xg=True)
-        def purge_task_states(task_state):
-            task_state.is_complete = task_state.is_permanently_failed = True
-            task_state.was_purged = True
-
-            task_state_fut = task_state.put_async()
-
-            delete_fut = (
-                ndb.Key(UniqueTaskMarker, task_state.task_reference)
-                .delete_async()
-            )
-
-            yield task_state_fut, delete_fut
-            raise ndb.Return(task_state_fut)
-
-        futures = []
-        for task_state in (
-                TaskState
-                .query(
-                    TaskState.queue_name == queue_name,
-                    TaskState.is_complete == False,
-                    TaskState.is_running == False
-                )):
-            futures.append(purge_task_states(task_state))
-
-        for fut in futures:
-            fut.get_result()
+        # marking every task as purged can take longer than a request
+        local.enqueue(purge_task_states, queue_name)
 
         self.response.content_type = "application/json"
         self.response.write(dump({
@@ -124,23 +104,68 @@ class QueueHandler(webapp2.RequestHandler):
 
 class TaskInfoHandler(webapp2.RequestHandler):
     def get(self, queue_name, task_id):
-        task_state = TaskState.get_by_id(int(task_id))
+        cache_key = cache.task_info_key(task_id)
+        payload = cache.get_payload(cache_key)
 
-        if not task_state:
+        if payload is None:
+            ctx = self.build_context(cache_key, int(task_id))
+        else:
+            ctx = json.loads(payload)
+
+        if ctx is None:
             self.response.set_status(404)
             return
 
+        # tasks can be deferred to depend on this one at any time, so these
+        # are never cached
+        ctx['dependents'] = [
+            t.to_dict() for t in
+            get_dependents(ndb.Key(TaskState, int(task_id))) if t
+        ]
+
+        self.response.content_type = "application/json"
+        self.response.write(dump(ctx))
+
+    @staticmethod
+    def build_context(cache_key, task_id):
+        task_state = TaskState.get_by_id(task_id)
+
+        if not task_state:
+            return
+
+        runstate.merge([task_state])
+
         ctx = {
             'task': task_state.to_dict(),
+            'dependencies': [
+                t.to_dict() for t in ndb.get_multi(task_state.dependencies) if t
+            ],
+            'profiles': [
+                p.to_dict() for p in
+                TaskProfile
+                .query(ancestor=task_state.key)
+                .order(-TaskProfile.created)
+                .fetch(10)
+            ],
         }
-        if task_state.request_log_ids:
+        log_ids = (
+            task_state.request_log_ids.split(',')
+            if task_state.request_log_ids else [])
+        if log_ids:
             ctx['logs'] = sorted(
-                get_logs(task_state.request_log_ids.split(','), logservice.LOG_LEVEL_INFO),
+                get_logs(log_ids, logservice.LOG_LEVEL_INFO),
                 key=itemgetter('start_time'),
                 reverse=True)
 
-        self.response.content_type = "application/json"
-        self.response.write(dump(ctx))
+        # nothing more will happen to a completed task once its logs are done,
+        # which includes logservice having returned all of them
+        logs = ctx.get('logs', ())
+        if task_state.is_complete and len(logs) == len(log_ids) and all(
+                log['finished'] for log in logs):
+            cache.set_payload(cache_key, dump(ctx))
+
+        return ctx
+
 
 class ReRunTaskHandler(webapp2.RequestHandler):
     def post(self, queue_name, task_id):
@@ -186,12 +211,135 @@ class LogHandler(webapp2.RequestHandler):
     def get(self, log_id):
         log_level = int(
             self.request.GET.get('level', logservice.LOG_LEVEL_INFO))
-        ctx = {
-            'log': next(get_logs([log_id], log_level), None)
-        }
+
+        cache_key = cache.log_key(log_id, log_level)
+        payload = cache.get_payload(cache_key)
+
+        if payload is None:
+            log = next(get_logs([log_id], log_level), None)
+            payload = dump({'log': log})
+
+            if log and log['finished']:
+                cache.set_payload(cache_key, payload)
 
         self.response.content_type = "application/json"
-        self.response.write(dump(ctx))
+        self.response.write(payload)
+
+
+class ExportHandler(webapp2.RequestHandler):
+    CONTENT_TYPES = {
+        'ndjson': 'application/x-ndjson',
+        'csv': 'text/csv',
+    }
+
+    def get(self, output_format):
+        fields = self.request.GET.get('fields')
+        fields = fields.split(',') if fields else export.DEFAULT_FIELDS
+
+        unknown_fields = set(fields) - set(export.get_fields())
+        if unknown_fields:
+            return self.bad_request(
+                "Unknown fields: " + ", ".join(sorted(unknown_fields)))
+
+        try:
+            batch_size = self.get_count('batch_size', export.DEFAULT_BATCH_SIZE)
+            limit = self.get_count('limit', export.DEFAULT_LIMIT)
+        except ValueError as e:
+            return self.bad_request(str(e))
+
+        cursor = self.request.GET.get('cursor')
+        try:
+            if cursor:
+                Cursor(urlsafe=cursor)
+        except datastore_errors.BadValueError:
+            return self.bad_request("Invalid cursor")
+
+        # responses are buffered, so each one is a part of the export which
+        # must fit within the request deadline and response size limit
+        _, cursor = export.export_task_states(
+            self.response,
+            queue_name=self.request.GET.get('queue'),
+            fields=fields,
+            output_format=output_format,
+            batch_size=batch_size,
+            cursor=cursor,
+            limit=limit)
+
+        self.response.content_type = self.CONTENT_TYPES[output_format]
+        self.response.headers['Content-Disposition'] = (
+            'attachment; filename="tasks.{0}"'.format(output_format))
+        if cursor:
+            self.response.headers['X-Export-Cursor'] = cursor
+
+    def get_count(self, name, default):
+        value = self.request.GET.get(name)
+        if not value:
+            return default
+
+        try:
+            value = int(value)
+        except ValueError:
+            value = 0
+
+        if value < 1:
+            raise ValueError("{0} must be a positive integer".format(name))
+        return value
+
+    def bad_request(self, message):
+        self.response.set_status(400)
+        self.response.content_type = "application/json"
+        self.response.write(dump({
+            "message": message
+        }))
+
+
+def purge_task_states(queue_name, cursor=None):
+    """
+    Mark the tasks waiting to run on a purged queue as purged, a batch at a
+    time, deferring the next.
+    """
+    if cursor:
+        cursor = Cursor(urlsafe=cursor)
+
+    task_states, cursor, more = (
+        TaskState
+        .query(
+            TaskState.queue_name == queue_name,
+            TaskState.is_complete == False,
+            TaskState.is_running == False
+        )
+        .fetch_page(PURGE_BATCH_SIZE, start_cursor=cursor)
+    )
+    # tasks running with their state in memcache aren't marked in the
+    # datastore
+    runstate.merge(task_states)
+
+    for task_state in task_states:
+        if not task_state.is_running:
+            _purge_task_state(task_state)
+
+    if more and cursor:
+        local.enqueue(purge_task_states, queue_name, cursor.urlsafe())
+
+
+# one plain transaction per task, as completing it reads and defers within
+# the current transaction, which interleaved tasklets can't be relied on to
+# keep apart
+@ndb.transactional(xg=True)
+def _purge_task_state(task_state):
+    task_state.was_purged = True
+    task_state.is_waiting = False
+    task_wrapper.complete_task(task_state, permanently_failed=True)
+
+
+def get_dependents(task_state_key, limit=100):
+    dependency_keys = (
+        TaskDependency
+        .query(ancestor=task_state_key)
+        .fetch(limit, keys_only=True)
+    )
+    return ndb.get_multi(
+        [ndb.Key(TaskState, key.id()) for key in dependency_keys])
 
 
 def get_logs(log_ids, log_level):
@@ -200,9 +348,11 @@ def get_logs(log_ids, log_level):
                                         include_app_logs=True,
                                         request_ids=log_ids):
 
-        d = {name: getattr(request_log, name)
-            for name, val in request_log.__class__.__dict__.iteritems()
-            if isinstance(val, property) and not name.startswith('_')
+        # only what the console shows, as the payloads are cached
+        d = {
+            'request_id': request_log.request_id,
+            'status': request_log.status,
+            'finished': request_log.finished,
         }
         d['start_time'] = datetime.datetime.fromtimestamp(
             request_log.start_time)
@@ -216,7 +366,7 @@ def get_logs(log_ids, log_level):
                 'level': app_log.level,
                 'message': app_log.message
             }
-            for app_log in d['app_logs']
+            for app_log in request_log.app_logs
             if app_log.level >= log_level
         ]
         yield d
@@ -0,0 +1,189 @@
+"""
+Benchmarks for the defer -> execute lifecycle and the console API.
+
+Runs offline against the same testbed stubs as the tests and writes the
+results as JSON so they can be compared between releases:
+
+    python runbenchmarks.py --sizes 1000,10000 --output results.json
+"""
+import argparse
+import collections
+import contextlib
+import gc
+import json
+import platform
+import resource
+import sys
+import time
+import webapp2
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import ndb
+
+from .tests import BaseTest, TaskQueueMixin, noop
+from .wrapper import defer
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+
+# page size used by the console when listing a queue
+LIST_PAGE_SIZE = 1000
+
+
+def current_rss_kb():
+    """
+    Resident set size of this process now, or None where /proc isn't
+    available. Unlike the peak from getrusage this can be compared between
+    scenarios run one after another in the same process.
+    """
+    try:
+        with open('/proc/self/statm') as fh:
+            resident_pages = int(fh.read().split()[1])
+    except (IOError, IndexError, ValueError):
+        return None
+
+    return resident_pages * resource.getpagesize() // 1024
+
+
+class Benchmarks(TaskQueueMixin, BaseTest):
+    # listing and purging use global queries which need to see every write
+    consistency_probability = 1
+
+    def setUp(self):
+        super(Benchmarks, self).setUp()
+
+        self.results = []
+        self.rpc_counts = collections.Counter()
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'deferred_manager_benchmarks', self.count_rpc)
+
+    def count_rpc(self, service, call, request, response):
+        self.rpc_counts['{0}.{1}'.format(service, call)] += 1
+
+    @contextlib.contextmanager
+    def measure(self, scenario, size):
+        ndb.get_context().clear_cache()
+        self.rpc_counts.clear()
+        gc.collect()
+
+        start_rss = current_rss_kb()
+        start = time.time()
+
+        yield
+
+        wall_time = time.time() - start
+        end_rss = current_rss_kb()
+
+        self.results.append({
+            'scenario': scenario,
+            'size': size,
+            'wall_time': wall_time,
+            'per_task_ms': wall_time * 1000 / size if size else None,
+            'rpc_count': sum(self.rpc_counts.values()),
+            'rpcs': dict(self.rpc_counts),
+            'rss_growth_kb': (
+                end_rss - start_rss if start_rss is not None else None),
+        })
+
+    @staticmethod
+    def console_request(path, method='GET'):
+        from .console import application
+
+        request = webapp2.Request.blank(
+            '/_ah/deferredconsole/api/' + path)
+        request.method = method
+        return request.get_response(application)
+
+    @staticmethod
+    def defer_tasks(size):
+        return [defer(noop, i) for i in xrange(size)]
+
+    def benchmark_defer(self, size):
+        with self.measure('defer', size):
+            self.defer_tasks(size)
+
+    def benchmark_execute(self, size):
+        self.defer_tasks(size)
+
+        with self.measure('execute', size):
+            self.run_queued_tasks()
+
+    def benchmark_list(self, size):
+        self.defer_tasks(size)
+
+        with self.measure('list', size):
+            cursor = ''
+            while True:
+                response = self.console_request(
+                    'default?limit={0}&cursor={1}'.format(
+                        LIST_PAGE_SIZE, cursor))
+                data = json.loads(response.body)
+                if not data['tasks'] or 'cursor' not in data:
+                    break
+                cursor = data['cursor']
+
+    def benchmark_purge(self, size):
+        self.defer_tasks(size)
+
+        with self.measure('purge', size):
+            self.console_request('default', method='DELETE')
+            # tasks are marked as purged by a chain of tasks
+            self.run_queued_tasks()
+
+    def benchmark_rerun(self, size):
+        task_states = self.defer_tasks(size)
+        self.run_queued_tasks()
+
+        with self.measure('rerun', size):
+            for task_state in task_states:
+                self.console_request(
+                    'default/{0}/rerun'.format(task_state.key.id()),
+                    method='POST')
+
+    @classmethod
+    def scenarios(cls):
+        return sorted(
+            name[len('benchmark_'):] for name in dir(cls)
+            if name.startswith('benchmark_'))
+
+
+def run(sizes=DEFAULT_SIZES, scenarios=None):
+    results = []
+
+    for scenario in scenarios or Benchmarks.scenarios():
+        for size in sizes:
+            benchmark = Benchmarks('benchmark_' + scenario)
+            benchmark.setUp()
+            try:
+                getattr(benchmark, 'benchmark_' + scenario)(size)
+            finally:
+                benchmark.tearDown()
+            results.extend(benchmark.results)
+
+    return {
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'results': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument(
+        '--sizes', default=','.join(str(s) for s in DEFAULT_SIZES),
+        help="comma separated numbers of tasks to run each scenario with")
+    parser.add_argument(
+        '--scenarios', default=','.join(Benchmarks.scenarios()),
+        help="comma separated scenarios to run")
+    parser.add_argument(
+        '--output', help="file to write the results to, defaults to stdout")
+    args = parser.parse_args(argv)
+
+    results = run(
+        sizes=[int(s) for s in args.sizes.split(',')],
+        scenarios=args.scenarios.split(','))
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
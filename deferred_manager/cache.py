@@ -0,0 +1,38 @@
+"""
+Read-through cache of the parts of console responses that can no longer
+change, such as the details and logs of completed tasks. Entries are
+compressed and left to expire or be evicted by memcache.
+"""
+import zlib
+
+from google.appengine.api import memcache
+
+from .config import config
+
+KEY_PREFIX = 'deferred_manager:console:'
+
+# largest value memcache will store
+MAX_VALUE_SIZE = 1000000
+
+
+def task_info_key(task_state_id):
+    return '{0}task:{1}'.format(KEY_PREFIX, task_state_id)
+
+
+def log_key(log_id, log_level):
+    return '{0}log:{1}:{2}'.format(KEY_PREFIX, log_id, log_level)
+
+
+def get_payload(key):
+    value = memcache.get(key)
+    if value is not None:
+        return zlib.decompress(value)
+
+
+def set_payload(key, payload):
+    if not config.CONSOLE_CACHE_TIME:
+        return
+
+    value = zlib.compress(payload)
+    if len(value) <= MAX_VALUE_SIZE:
+        memcache.set(key, value, time=config.CONSOLE_CACHE_TIME)
@@ -0,0 +1,30 @@
+"""
+Settings for deferred_manager. Override any of these in appengine_config.py
+by prefixing the name with `deferred_manager_`, e.g.
+
+    deferred_manager_PROFILE_SAMPLE_RATE = 0.01
+"""
+from google.appengine.api import lib_config
+
+
+config = lib_config.register('deferred_manager', {
+    # deferred functions to always profile, named as shown in the console
+    # e.g. "myapp.tasks.send_email"
+    'PROFILE_FUNCTIONS': (),
+    # fraction of all other tasks to profile, between 0 and 1
+    'PROFILE_SAMPLE_RATE': 0.0,
+    # number of shards to spread TaskState index writes over, 0 to disable
+    'TASK_STATE_SHARDS': 0,
+    # keep the running state of tasks in memcache and only write finished
+    # tasks to the datastore
+    'MEMCACHE_RUNNING_STATE': False,
+    # seconds to cache console views of completed tasks for, 0 to disable
+    'CONSOLE_CACHE_TIME': 24 * 60 * 60,
+    # run deferred tasks in this process instead of on the taskqueue, for
+    # tests and batch scripts
+    'EAGER': False,
+    # threads to run eager tasks on, 0 to run them inline
+    'EAGER_THREADS': 0,
+    # attempts at running an eager task before giving up on it
+    'EAGER_MAX_ATTEMPTS': 20,
+})
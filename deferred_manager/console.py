@@ -13,5 +13,6 @@ application = webapp2.WSGIApplication([
     (r'.+/deferredconsole/api/([\w\d-]+)/([\w\d-]+)', api.TaskInfoHandler),
     (r'.+/deferredconsole/api/([\w\d-]+)', api.QueueHandler),
     (r'.+/deferredconsole/api.*', api.QueueListHandler),
+    (r'.+/deferredconsole/export\.(ndjson|csv)', api.ExportHandler),
     (r'(.+)/deferredconsole.*', HomeHandler),
 ])
@@ -0,0 +1,208 @@
+import collections
+import logging
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb, deferred
+
+from . import local
+from .config import config
+from .models import TaskState, TaskDependency, DependencyCounter
+
+# maximum number of tasks that can be added to a queue in one call
+RELEASE_BATCH_SIZE = 100
+
+# most shards to tally a waiting task's completed dependencies over
+DEPENDENCY_COUNTER_SHARDS = 20
+
+
+def register_dependencies(task_state_id):
+    """
+    Record the edges from each parent to the waiting task `task_state_id` and
+    release it straight away if the parents have already finished. Deferred
+    in the transaction that creates the waiting task, so that the taskqueue
+    retries it until nothing is left waiting without edges.
+
+    Edges live in the parents' entity groups so a parent completing can find
+    its dependents with a strongly consistent ancestor query. Either the
+    parent's completion transaction sees the edge, or the check below sees the
+    parent as complete.
+    """
+    task_state = TaskState.get_by_id(
+        task_state_id, use_cache=False, use_memcache=False)
+
+    if not task_state or not task_state.is_waiting:
+        return
+
+    ndb.put_multi([
+        TaskDependency(parent=parent_key, id=task_state_id)
+        for parent_key in task_state.dependencies
+    ])
+
+    release_task(task_state_id)
+
+
+def notify_dependents(task_state):
+    """
+    Enqueue a fan out of release checks if anything is waiting on
+    `task_state`. Must be called in the transaction that marks it complete.
+    """
+    has_dependents = (
+        TaskDependency
+        .query(ancestor=task_state.key)
+        .get(keys_only=True)
+    )
+
+    if has_dependents:
+        local.enqueue(
+            release_dependents,
+            task_state.key.id(),
+            task_state.queue_name,
+            _queue=task_state.queue_name,
+            _transactional=True)
+
+
+def release_dependents(task_state_id, queue_name, cursor=None):
+    """
+    Enqueue a release check for every task waiting on `task_state_id`, a
+    batch at a time so that very wide graphs don't need one huge request.
+    """
+    if cursor:
+        cursor = Cursor(urlsafe=cursor)
+
+    dependent_keys, cursor, more = (
+        TaskDependency
+        .query(ancestor=ndb.Key(TaskState, task_state_id))
+        .fetch_page(RELEASE_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+    )
+
+    if config.EAGER:
+        for key in dependent_keys:
+            local.enqueue(release_task, key.id(), task_state_id)
+
+    elif dependent_keys:
+        taskqueue.Queue(queue_name).add([
+            taskqueue.Task(
+                payload=deferred.serialize(
+                    release_task, key.id(), task_state_id),
+                url=deferred._DEFAULT_URL,
+                headers=deferred._TASKQUEUE_HEADERS)
+            for key in dependent_keys
+        ])
+
+    if more and cursor:
+        local.enqueue(
+            release_dependents,
+            task_state_id,
+            queue_name,
+            cursor.urlsafe(),
+            _queue=queue_name)
+
+
+def release_task(task_state_id, parent_id=None):
+    """
+    Count the completed `parent_id` towards the waiting task `task_state_id`
+    and enqueue the task once all of its dependencies are counted, or fail it
+    if the parent failed. Without a `parent_id` all of the dependencies are
+    checked, as when the task is first deferred.
+
+    Completions are tallied in sharded counters so that each parent finishing
+    only reads itself and the counters rather than every other parent, and
+    parents finishing together are spread over the shards. The task itself
+    is only written to by whichever check sees the tally reach the total.
+    Everything is read straight from the datastore, as a copy cached when a
+    parent was deferred in this request won't show it completing elsewhere.
+    """
+    task_state = TaskState.get_by_id(
+        task_state_id, use_cache=False, use_memcache=False)
+
+    if not task_state or not task_state.is_waiting:
+        return
+
+    if parent_id is None:
+        parent_keys = task_state.dependencies
+    else:
+        parent_keys = [ndb.Key(TaskState, parent_id)]
+
+    parents = ndb.get_multi(parent_keys, use_cache=False, use_memcache=False)
+
+    if any(parent is None or parent.is_permanently_failed for parent in parents):
+        logging.warning(
+            "Task with ID {0} will not be run as a task it depends on has "
+            "failed or no longer exists".format(task_state_id))
+        _fail_waiting_task(task_state.key)
+        return
+
+    completed = _count_completed(task_state, [
+        parent.key.id() for parent in parents if parent.is_complete])
+
+    if completed >= len(task_state.dependencies):
+        _enqueue_waiting_task(task_state.key)
+
+
+def _count_completed(task_state, parent_ids):
+    """
+    Add `parent_ids` to the tally of the waiting task's completed
+    dependencies, returning the new total.
+    """
+    counter_keys = [
+        ndb.Key(DependencyCounter, '{0}:{1}'.format(task_state.key.id(), shard))
+        for shard in xrange(min(
+            len(task_state.dependencies), DEPENDENCY_COUNTER_SHARDS))
+    ]
+
+    by_shard = collections.defaultdict(list)
+    for parent_id in parent_ids:
+        by_shard[parent_id % len(counter_keys)].append(parent_id)
+
+    for shard, shard_parent_ids in by_shard.iteritems():
+        _add_to_counter(counter_keys[shard], shard_parent_ids)
+
+    counters = ndb.get_multi(
+        counter_keys, use_cache=False, use_memcache=False)
+
+    return sum(len(counter.completed) for counter in counters if counter)
+
+
+@ndb.transactional
+def _add_to_counter(counter_key, parent_ids):
+    counter = counter_key.get() or DependencyCounter(key=counter_key)
+
+    new_ids = set(parent_ids).difference(counter.completed)
+    if new_ids:
+        counter.completed.extend(new_ids)
+        counter.put()
+
+
+@ndb.transactional(xg=True)
+def _enqueue_waiting_task(task_state_key):
+    from .handler import task_wrapper
+
+    task_state = task_state_key.get()
+
+    if not task_state.is_waiting:
+        return
+
+    task_state.is_waiting = False
+    task_state.put()
+
+    local.enqueue(
+        task_wrapper,
+        task_state.key.id(),
+        task_state.pickle,
+        task_state.task_reference,
+        _transactional=True,
+        **(task_state.defer_kwargs or {}))
+
+
+@ndb.transactional(xg=True)
+def _fail_waiting_task(task_state_key):
+    from .handler import task_wrapper
+
+    task_state = task_state_key.get()
+
+    if not task_state.is_waiting:
+        return
+
+    task_state.is_waiting = False
+    task_wrapper.complete_task(task_state, permanently_failed=True)
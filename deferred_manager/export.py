@@ -0,0 +1,198 @@
+"""
+Export of task history as newline delimited JSON or CSV. Tasks are read a
+batch at a time, with the next batch fetched while the current one is
+written, and nothing is kept in memory between batches.
+
+From a remote_api shell:
+
+    from deferred_manager.export import export_task_states
+    with open('tasks.ndjson', 'w') as fh:
+        export_task_states(fh, queue_name='default')
+
+An export can be split up with `limit`, carrying on from the cursor returned
+by the previous part, as the console does since its responses must fit within
+a request.
+"""
+import csv
+import datetime
+import json
+
+from google.appengine.datastore.datastore_query import Cursor
+
+from .models import TaskState
+
+FORMATS = ('ndjson', 'csv')
+
+DEFAULT_FIELDS = (
+    'key',
+    'queue_name',
+    'task_name',
+    'task_reference',
+    'deferred_function',
+    'deferred_args',
+    'deferred_kwargs',
+    'deferred_at',
+    'first_run',
+    'retry_count',
+    'is_complete',
+    'is_permanently_failed',
+    'was_purged',
+)
+
+# properties which can't be usefully exported
+EXCLUDED_FIELDS = ('pickle', 'defer_kwargs', 'on_complete')
+
+DEFAULT_BATCH_SIZE = 500
+
+# most tasks exported by one console request
+DEFAULT_LIMIT = 10000
+
+
+def get_fields():
+    return ('key',) + tuple(sorted(
+        name for name in TaskState._properties
+        if name not in EXCLUDED_FIELDS))
+
+
+class TaskStateReader(object):
+    """
+    Iterates over task states in key order, which is unrelated to when they
+    were deferred as ids are allocated in scattered order. Once iterated
+    over, `cursor` is a urlsafe cursor to carry on from, or None if there are
+    no more.
+    """
+    def __init__(
+            self,
+            queue_name=None,
+            batch_size=DEFAULT_BATCH_SIZE,
+            cursor=None,
+            limit=None):
+        self.query = TaskState.query()
+        if queue_name:
+            self.query = self.query.filter(TaskState.queue_name == queue_name)
+
+        self.batch_size = batch_size
+        self.cursor = cursor
+        self.limit = limit
+
+    def __iter__(self):
+        remaining = self.limit
+        cursor = Cursor(urlsafe=self.cursor) if self.cursor else None
+
+        future = self._fetch_async(cursor, remaining)
+        while future:
+            task_states, cursor, more = future.get_result()
+
+            if remaining is not None:
+                remaining -= len(task_states)
+
+            if more and cursor and remaining != 0:
+                future = self._fetch_async(cursor, remaining)
+            else:
+                future = None
+
+            for task_state in task_states:
+                yield task_state
+
+            self.cursor = cursor.urlsafe() if more and cursor else None
+
+    def _fetch_async(self, cursor, remaining):
+        batch_size = self.batch_size
+        if remaining is not None:
+            batch_size = min(batch_size, remaining)
+
+        # skip the caches so memory use doesn't grow with the number of tasks
+        return self.query.fetch_page_async(
+            batch_size,
+            start_cursor=cursor,
+            use_cache=False,
+            use_memcache=False)
+
+
+def get_row(task_state, fields):
+    row = []
+    for field in fields:
+        if field == 'key':
+            value = task_state.key.id()
+        else:
+            value = getattr(task_state, field)
+
+        if isinstance(value, datetime.datetime):
+            value = value.isoformat()
+        elif isinstance(value, list):
+            value = [v.id() if hasattr(v, 'id') else v for v in value]
+
+        row.append(value)
+    return row
+
+
+def iter_lines(task_states, fields=DEFAULT_FIELDS, output_format='ndjson'):
+    if output_format == 'ndjson':
+        for task_state in task_states:
+            yield json.dumps(
+                dict(zip(fields, get_row(task_state, fields)))) + '\n'
+
+    elif output_format == 'csv':
+        buf = _LineBuffer()
+        writer = csv.writer(buf)
+
+        writer.writerow(fields)
+        yield buf.pop()
+
+        for task_state in task_states:
+            writer.writerow([
+                _csv_value(value) for value in get_row(task_state, fields)])
+            yield buf.pop()
+
+    else:
+        raise ValueError(
+            "output_format must be one of {0}".format(FORMATS))
+
+
+def export_task_states(
+        out,
+        queue_name=None,
+        fields=DEFAULT_FIELDS,
+        output_format='ndjson',
+        batch_size=DEFAULT_BATCH_SIZE,
+        cursor=None,
+        limit=None):
+    """
+    Write up to `limit` tasks to the file-like `out`, starting from `cursor`.
+    Returns the number written and a cursor to carry on from, or None if
+    there are no more.
+    """
+    reader = TaskStateReader(queue_name, batch_size, cursor, limit)
+
+    count = 0
+    for line in iter_lines(reader, fields, output_format):
+        out.write(line)
+        count += 1
+
+    if output_format == 'csv':
+        # don't count the header
+        count -= 1
+
+    return count, reader.cursor
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        value = json.dumps(value)
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+class _LineBuffer(object):
+    def __init__(self):
+        self.lines = []
+
+    def write(self, line):
+        self.lines.append(line)
+
+    def pop(self):
+        lines, self.lines = self.lines, []
+        return ''.join(lines)
@@ -1,12 +1,15 @@
 import datetime
 import logging
-import os
 import pickle
 
 from google.appengine.ext import ndb, deferred
-from google.appengine.api import queueinfo
+from google.appengine.api import memcache, queueinfo
 
+from . import local, runstate
+from .config import config
+from .dependencies import notify_dependents
 from .models import TaskState, UniqueTaskMarker
+from .profiler import profile, should_profile
 
 from .utils import attrgetter, get_func_repr, get_queue_info
 
@@ -19,13 +22,18 @@ class TaskWrapper(object):
         fn, fn_args, fn_kwargs = pickle.loads(obj)
 
         task_state = self.get_task_state(task_state_key)
+        completed = False
 
         try:
-            fn(*fn_args, **fn_kwargs)
+            if task_state and should_profile(task_state):
+                profile(task_state, fn, *fn_args, **fn_kwargs)
+            else:
+                fn(*fn_args, **fn_kwargs)
 
         except deferred.SingularTaskFailure as e:
             if task_state and not self.should_retry(task_state):
                 self.complete_task(task_state, permanently_failed=True)
+                completed = True
             else:
                 logging.debug("Failure executing task, task retry forced")
                 raise
@@ -34,6 +42,7 @@ class TaskWrapper(object):
             logging.exception("Permanent failure attempting to execute task")
             if task_state:
                 self.complete_task(task_state, permanently_failed=True)
+                completed = True
             raise
 
         except Exception as e:
@@ -41,6 +50,7 @@ class TaskWrapper(object):
 
             if task_state and not self.should_retry(task_state):
                 self.complete_task(task_state, permanently_failed=True)
+                completed = True
                 logging.warning(
                     "Task has failed {0} times and is {1}s old. "
                     "It will not be retried."
@@ -51,17 +61,78 @@ class TaskWrapper(object):
         else:
             if task_state:
                 self.complete_task(task_state)
+                completed = True
 
         finally:
-            if task_state:
+            # completed tasks were already written by complete_task. If its
+            # transaction failed the task isn't complete, whatever it set on
+            # the entity, and must not be left marked as running
+            if task_state and not completed:
+                task_state.is_complete = False
+                task_state.is_permanently_failed = False
                 task_state.is_running = False
-                task_state.put()
+                if config.MEMCACHE_RUNNING_STATE:
+                    runstate.save(task_state)
+                else:
+                    task_state.put()
 
-    @staticmethod
+    @classmethod
+    def get_task_state(cls, task_state_key):
+        if config.MEMCACHE_RUNNING_STATE:
+            return cls.get_task_state_from_memcache(task_state_key)
+
+        return cls.get_task_state_from_datastore(task_state_key)
+
+    @classmethod
     @ndb.transactional
-    def get_task_state(task_state_key):
+    def get_task_state_from_datastore(cls, task_state_key):
         task_state = TaskState.get_by_id(task_state_key)
 
+        cls.check_task_state(task_state_key, task_state)
+        cls.mark_running(task_state)
+
+        task_state.put()
+
+        return task_state
+
+    @classmethod
+    def get_task_state_from_memcache(cls, task_state_key):
+        """
+        Only read the TaskState and mark it as running in memcache. The
+        compare-and-set stands in for the transaction to stop the same task
+        running twice at once.
+        """
+        task_state = TaskState.get_by_id(task_state_key)
+
+        cls.check_task_state(task_state_key, task_state)
+
+        client = memcache.Client()
+        key = runstate.get_key(task_state_key)
+        state = client.gets(key)
+
+        if state:
+            runstate.apply(task_state, state)
+            cls.check_task_state(task_state_key, task_state)
+
+        cls.mark_running(task_state)
+
+        if state:
+            stored = client.cas(
+                key, runstate.snapshot(task_state), time=runstate.RUNNING_TIME)
+        else:
+            stored = client.add(
+                key, runstate.snapshot(task_state), time=runstate.RUNNING_TIME)
+
+        if not stored:
+            raise deferred.SingularTaskFailure(
+                "Could not mark task with ID {0} as running. It may have "
+                "been started by another request.".format(task_state_key)
+            )
+
+        return task_state
+
+    @staticmethod
+    def check_task_state(task_state_key, task_state):
         if not task_state:
             raise deferred.SingularTaskFailure(
                 "Task with ID {0} has no task state. This shouldn't happen. "
@@ -84,35 +155,54 @@ class TaskWrapper(object):
                     task_state)
             )
 
+    @staticmethod
+    def mark_running(task_state):
+        execution = local.get_execution()
+
         task_state.is_running = True
-        task_state.task_name = os.environ['HTTP_X_APPENGINE_TASKNAME']
+        task_state.task_name = execution['task_name']
 
-        task_state.retry_count = int(os.environ['HTTP_X_APPENGINE_TASKEXECUTIONCOUNT'])
+        task_state.retry_count = execution['retry_count']
 
-        if task_state.request_log_ids is None:
-            task_state.request_log_ids = os.environ['REQUEST_LOG_ID']
-        else:
-            task_state.request_log_ids += "," + os.environ['REQUEST_LOG_ID']
+        request_log_id = execution['request_log_id']
+
+        # tasks run locally have no request log
+        if request_log_id is not None:
+            if task_state.request_log_ids is None:
+                task_state.request_log_ids = request_log_id
+            else:
+                task_state.request_log_ids += "," + request_log_id
 
         if task_state.first_run is None:
             task_state.first_run = datetime.datetime.utcnow()
 
-        task_state.put()
-
-        return task_state
-
     @staticmethod
     @ndb.transactional(xg=True)
     def complete_task(task_state, permanently_failed=False):
+        from .wrapper import defer
+
         task_state.is_complete = True
+        task_state.is_running = False
         task_state.is_permanently_failed = permanently_failed
+        task_state.put()
 
         if task_state.unique:
             ndb.Key(UniqueTaskMarker, task_state.task_reference).delete()
 
+        if task_state.on_complete:
+            # serialize curries methods and the like into args and kwargs
+            fn, args, kwargs = pickle.loads(task_state.on_complete)
+            defer(
+                fn,
+                *(args + (task_state.key.id(),)),
+                _queue=task_state.queue_name,
+                **kwargs)
+
+        notify_dependents(task_state)
+
     def should_retry(self, task_state):
-        retry_limit = self.get_retry_limit()
-        age_limit = self.get_age_limit()
+        retry_limit = self.get_retry_limit(task_state.queue_name)
+        age_limit = self.get_age_limit(task_state.queue_name)
         # TODO: handle default retry params and task-specific retry params
         if retry_limit is not None and age_limit is not None:
             return (
@@ -128,22 +218,21 @@ class TaskWrapper(object):
 
         return True
 
-    def get_queue_info(self):
-        queue_name = os.environ['HTTP_X_APPENGINE_QUEUENAME']
+    def get_queue_info(self, queue_name):
         return next(
             qi for qi in self.all_queue_info if qi.name == queue_name)
 
-    def get_retry_limit(self):
+    def get_retry_limit(self, queue_name):
         try:
-            limit = attrgetter("retry_parameters.task_retry_limit")(self.get_queue_info())
+            limit = attrgetter("retry_parameters.task_retry_limit")(self.get_queue_info(queue_name))
         except AttributeError:
             limit = None
 
         if limit is not None:
             return int(limit)
 
-    def get_age_limit(self):
-        limit = attrgetter("retry_parameters.task_age_limit")(self.get_queue_info())
+    def get_age_limit(self, queue_name):
+        limit = attrgetter("retry_parameters.task_age_limit")(self.get_queue_info(queue_name))
 
         if limit is not None:
             queueinfo.ParseTaskAgeLimit(limit)
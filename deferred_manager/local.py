@@ -0,0 +1,226 @@
+"""
+Eager execution of deferred tasks in this process, for tests and batch
+scripts. When `EAGER` is enabled tasks are run as soon as the transaction
+that deferred them commits, either inline or on a thread pool of
+`EAGER_THREADS` threads, going through TaskWrapper exactly as they would on
+the taskqueue, including retries.
+"""
+import collections
+import functools
+import logging
+import os
+import pickle
+import threading
+import uuid
+
+from multiprocessing.pool import ThreadPool
+
+from google.appengine.ext import ndb, deferred
+
+from .config import config
+from .models import TaskState
+from .utils import strip_defer_kwargs
+
+_local = threading.local()
+
+_pool = None
+_pool_size = None
+_pool_lock = threading.Lock()
+# pools replaced after EAGER_THREADS changed, to be joined by wait()
+_closed_pools = []
+
+# number of tasks submitted but not yet finished, across all threads
+_outstanding = 0
+_outstanding_changed = threading.Condition()
+
+
+def enqueue(obj, *args, **kwargs):
+    """
+    deferred.defer, or a stand-in for it which runs the task locally if
+    `EAGER` is enabled. Options such as `_countdown` are ignored when running
+    locally, `_transactional` is honoured.
+    """
+    if not config.EAGER:
+        return deferred.defer(obj, *args, **kwargs)
+
+    # serialize now, as the taskqueue would, so later changes to the
+    # arguments aren't seen and anything unpicklable fails here
+    payload = deferred.serialize(obj, *args, **strip_defer_kwargs(kwargs))
+
+    ndb.get_context().call_on_commit(functools.partial(_submit, payload))
+
+
+def get_execution():
+    """
+    Details of the current attempt at running a task, from the task's
+    request headers unless it is being run locally.
+    """
+    execution = getattr(_local, 'execution', None)
+
+    if execution is None:
+        execution = {
+            'task_name': os.environ['HTTP_X_APPENGINE_TASKNAME'],
+            'retry_count': int(os.environ['HTTP_X_APPENGINE_TASKEXECUTIONCOUNT']),
+            'request_log_id': os.environ['REQUEST_LOG_ID'],
+        }
+
+    return execution
+
+
+def run_pending():
+    """
+    Run the tasks deferred inline on this thread, and any they defer in turn.
+    Tasks deferred while this is already running are picked up by the outer
+    call rather than recursing.
+    """
+    if getattr(_local, 'running', False):
+        return
+
+    _local.running = True
+    try:
+        pending = _get_pending()
+        while pending:
+            _run(pending.popleft())
+    finally:
+        _local.running = False
+
+
+def wait():
+    """
+    Block until every locally deferred task has finished.
+    """
+    run_pending()
+
+    with _outstanding_changed:
+        while _outstanding:
+            _outstanding_changed.wait()
+
+    # not joined when closed, as that may be from one of their own threads
+    with _pool_lock:
+        closed_pools = _closed_pools[:]
+        del _closed_pools[:]
+
+    for pool in closed_pools:
+        pool.join()
+
+
+def _get_pending():
+    if not hasattr(_local, 'pending'):
+        _local.pending = collections.deque()
+    return _local.pending
+
+
+def _get_pool():
+    global _pool, _pool_size
+
+    with _pool_lock:
+        if _pool_size != config.EAGER_THREADS:
+            if _pool is not None:
+                # its threads exit once the tasks already given to it finish
+                _pool.close()
+                _closed_pools.append(_pool)
+
+            _pool = ThreadPool(config.EAGER_THREADS)
+            _pool_size = config.EAGER_THREADS
+        return _pool
+
+
+def _submit(payload):
+    global _outstanding
+
+    with _outstanding_changed:
+        _outstanding += 1
+
+    # called on commit, so must not raise or run the task here
+    if config.EAGER_THREADS:
+        _get_pool().apply_async(_run, (payload,))
+    else:
+        _get_pending().append(payload)
+
+
+def _run(payload):
+    global _outstanding
+
+    task_name = 'local-' + uuid.uuid4().hex
+    task_state_id = _get_task_state_id(payload)
+
+    try:
+        for retry_count in xrange(config.EAGER_MAX_ATTEMPTS):
+            _local.execution = {
+                'task_name': task_name,
+                'retry_count': retry_count,
+                'request_log_id': None,
+            }
+
+            try:
+                deferred.run(payload)
+                return
+
+            except deferred.PermanentTaskFailure:
+                logging.exception(
+                    "Permanent failure attempting to execute local task")
+                return
+
+            except Exception:
+                # the wrapper re-raises after marking a task as failed for
+                # good, for the taskqueue to log
+                if _is_complete(task_state_id):
+                    return
+
+                logging.exception(
+                    "Failure executing local task, task will be retried")
+
+            finally:
+                _local.execution = None
+
+        logging.error(
+            "Local task {0} failed {1} times and will not be retried".format(
+                task_name, config.EAGER_MAX_ATTEMPTS))
+
+        _fail(task_state_id)
+
+    finally:
+        # worker threads live on, don't let their caches grow with each task
+        ndb.get_context().clear_cache()
+
+        with _outstanding_changed:
+            _outstanding -= 1
+            _outstanding_changed.notify_all()
+
+
+def _get_task_state_id(payload):
+    """
+    ID of the TaskState of a task deferred through the wrapper, or None for
+    other deferred functions such as dependency checks.
+    """
+    from .handler import TaskWrapper
+
+    try:
+        fn, args, kwargs = pickle.loads(payload)
+    except Exception:
+        # deferred.run will report it
+        return None
+
+    if isinstance(fn, TaskWrapper):
+        return args[0]
+
+
+def _is_complete(task_state_id):
+    if task_state_id is None:
+        return False
+
+    task_state = TaskState.get_by_id(
+        task_state_id, use_cache=False, use_memcache=False)
+    return task_state is not None and task_state.is_complete
+
+
+def _fail(task_state_id):
+    from .handler import task_wrapper
+
+    if task_state_id is None:
+        return
+
+    task_state = TaskState.get_by_id(
+        task_state_id, use_cache=False, use_memcache=False)
+    if task_state and not task_state.is_complete:
+        task_wrapper.complete_task(task_state, permanently_failed=True)
@@ -0,0 +1,67 @@
+"""
+Updates to stored task states needed when upgrading this library or changing
+its settings. Each runs as a chain of deferred tasks once the new code has
+been deployed, e.g. from a remote_api shell:
+
+    from deferred_manager import migrations
+    from google.appengine.ext import deferred
+    deferred.defer(migrations.reshard_task_states)
+"""
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from . import local
+from .models import TaskState
+
+BATCH_SIZE = 500
+
+
+def reshard_task_states(cursor=None, batch_size=BATCH_SIZE):
+    """
+    Bring task states in line with `TASK_STATE_SHARDS` after it is changed,
+    so that the console lists them. With sharding enabled, those written
+    before it was are given a sort key, and those in shards no longer in use
+    are moved. With it disabled, sort keys are removed. A batch is done at a
+    time, deferring the next.
+    """
+    if cursor:
+        cursor = Cursor(urlsafe=cursor)
+
+    task_states, cursor, more = (
+        TaskState
+        .query()
+        .fetch_page(
+            batch_size,
+            start_cursor=cursor,
+            use_cache=False,
+            use_memcache=False)
+    )
+
+    shard_count = TaskState.get_shard_count()
+
+    for task_state in task_states:
+        if shard_count == 1:
+            outdated = task_state.sort_key is not None
+        else:
+            outdated = (
+                task_state.sort_key is None or task_state.shard >= shard_count)
+
+        if outdated:
+            _reshard_task_state(task_state.key)
+
+    if more and cursor:
+        local.enqueue(reshard_task_states, cursor.urlsafe(), batch_size)
+
+
+@ndb.transactional
+def _reshard_task_state(task_state_key):
+    # re-read so that tasks updated since the batch was fetched aren't
+    # overwritten
+    task_state = task_state_key.get()
+
+    if TaskState.get_shard_count() == 1:
+        task_state.clear_sort_key()
+    else:
+        task_state.set_sort_key()
+
+    task_state.put()
@@ -1,7 +1,27 @@
 import datetime
+import heapq
+import random
 
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
+from .config import config
+
+# separates the per shard cursors within a sharded listing cursor
+SHARD_CURSOR_SEPARATOR = '.'
+# marks a shard with nothing left to list
+SHARD_EXHAUSTED = '~'
+
+# sort keys are the shard then the time the task was deferred, fixed width
+# so that they order the same as the times in them
+SORT_KEY_PREFIX = '{0:04d}:'
+SORT_KEY_FORMAT = SORT_KEY_PREFIX + '{1:%Y-%m-%dT%H:%M:%S.%f}'
+# sorts after every character of a sort key's time
+SORT_KEY_END = '~'
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
 
 class TaskState(ndb.Model):
     task_name = ndb.StringProperty()
@@ -11,6 +31,7 @@ class TaskState(ndb.Model):
     unique = ndb.BooleanProperty(default=False)
     is_complete = ndb.BooleanProperty(default=False)
     is_running = ndb.BooleanProperty(default=False)
+    is_waiting = ndb.BooleanProperty(default=False)
     is_permanently_failed = ndb.BooleanProperty(default=False)
     was_purged = ndb.BooleanProperty(default=False)
     first_run = ndb.DateTimeProperty(required=False, default=None)
@@ -19,10 +40,23 @@ class TaskState(ndb.Model):
     deferred_args = ndb.TextProperty()
     deferred_kwargs = ndb.TextProperty()
     deferred_at = ndb.DateTimeProperty(auto_now_add=True)
+    shard = ndb.IntegerProperty(indexed=False)
     pickle = ndb.BlobProperty()
 
+    # with sharding enabled, the shard then deferred_at, so that new tasks
+    # are written to one index range per shard rather than all to the newest
+    # end of one range
+    sort_key = ndb.StringProperty()
+
     request_log_ids = ndb.TextProperty()
 
+    # tasks deferred with `depends_on` are held back until every one of
+    # these has completed; the options to enqueue them with are kept here
+    dependencies = ndb.KeyProperty(
+        kind='TaskState', repeated=True, indexed=False)
+    defer_kwargs = ndb.PickleProperty()
+    on_complete = ndb.BlobProperty()
+
     @property
     def age(self):
         if self.first_run is not None:
@@ -31,8 +65,182 @@ class TaskState(ndb.Model):
     def to_dict(self):
         data = super(TaskState, self).to_dict()
         del data['pickle']
+        del data['defer_kwargs']
+        del data['on_complete']
         data['key'] = self.key.id()
+        data['dependencies'] = [k.id() for k in self.dependencies]
         return data
 
+    def _pre_put_hook(self):
+        if self.sort_key is None and self.get_shard_count() > 1:
+            self.set_sort_key()
+
+        if self.sort_key is not None:
+            # listed by sort key, so deferred_at is left out of the indexes
+            # rather than written to the newest end of its built-in one
+            self._clone_properties()
+            self._properties['deferred_at'] = _UNINDEXED_DEFERRED_AT
+
+    def set_sort_key(self):
+        """
+        Give the task a sort key, keeping its shard if that is still in use.
+        """
+        if self.deferred_at is None:
+            self.deferred_at = datetime.datetime.utcnow()
+
+        if self.shard is None or self.shard >= self.get_shard_count():
+            self.shard = self.random_shard()
+
+        self.sort_key = SORT_KEY_FORMAT.format(self.shard, self.deferred_at)
+
+    def clear_sort_key(self):
+        self.sort_key = self.shard = None
+        self._properties = type(self)._properties
+
+    @staticmethod
+    def get_shard_count():
+        return max(1, config.TASK_STATE_SHARDS)
+
+    @classmethod
+    def random_shard(cls):
+        return random.randrange(cls.get_shard_count())
+
+    @classmethod
+    def fetch_queue_page(cls, queue_name, limit, cursor=None):
+        """
+        Fetch a page of a queue's tasks, newest first. Returns the tasks, a
+        urlsafe cursor for the next page and whether there may be more.
+        """
+        if cls.get_shard_count() == 1:
+            tasks, cursor, more = (
+                cls.query(cls.queue_name == queue_name)
+                .order(-cls.deferred_at)
+                .fetch_page(
+                    limit,
+                    start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+            )
+            return tasks, cursor and cursor.urlsafe(), more
+
+        return cls._fetch_sharded_queue_page(queue_name, limit, cursor)
+
+    @classmethod
+    def _fetch_sharded_queue_page(cls, queue_name, limit, cursor):
+        """
+        K-way merge of one query per shard. The cursor holds a cursor for each
+        shard, positioned after the last of its tasks that made it into a page.
+        """
+        shards = range(cls.get_shard_count())
+
+        if cursor:
+            cursors = cursor.split(SHARD_CURSOR_SEPARATOR)
+            if len(cursors) != len(shards):
+                raise datastore_errors.BadValueError(
+                    "Cursor does not match the number of shards")
+        else:
+            cursors = [''] * len(shards)
+
+        # shards are randomly assigned so each one should only need to
+        # contribute its share of the page
+        batch_size = min(limit, 2 * limit // len(shards) + 1)
+
+        iterators = {}
+        for shard, shard_cursor in zip(shards, cursors):
+            if shard_cursor == SHARD_EXHAUSTED:
+                continue
+
+            start = SORT_KEY_PREFIX.format(shard)
+
+            iterators[shard] = (
+                cls.query(
+                    cls.queue_name == queue_name,
+                    cls.sort_key > start,
+                    cls.sort_key < start + SORT_KEY_END)
+                .order(-cls.sort_key)
+                .iter(
+                    batch_size=batch_size,
+                    produce_cursors=True,
+                    start_cursor=(
+                        Cursor(urlsafe=shard_cursor) if shard_cursor else None))
+            )
+
+        # fetch the first batch of every shard in parallel
+        has_next = {
+            shard: iterator.has_next_async()
+            for shard, iterator in iterators.iteritems()
+        }
+
+        heap = []
+        for shard, iterator in iterators.iteritems():
+            if has_next[shard].get_result():
+                task = iterator.next()
+                heap.append((cls._newest_first(task), shard, task))
+            else:
+                cursors[shard] = SHARD_EXHAUSTED
+        heapq.heapify(heap)
+
+        tasks = []
+        while heap:
+            _, shard, task = heapq.heappop(heap)
+            tasks.append(task)
+
+            iterator = iterators[shard]
+            cursors[shard] = iterator.cursor_after().urlsafe()
+
+            if len(tasks) == limit:
+                # don't fetch another batch just to see whether there is one
+                if not iterator.probably_has_next():
+                    cursors[shard] = SHARD_EXHAUSTED
+                break
+
+            if iterator.has_next():
+                task = iterator.next()
+                heapq.heappush(heap, (cls._newest_first(task), shard, task))
+            else:
+                cursors[shard] = SHARD_EXHAUSTED
+
+        if all(c == SHARD_EXHAUSTED for c in cursors):
+            return tasks, None, False
+
+        return tasks, SHARD_CURSOR_SEPARATOR.join(cursors), True
+
+    @staticmethod
+    def _newest_first(task_state):
+        return -(task_state.deferred_at - EPOCH).total_seconds()
+
+# stands in for TaskState.deferred_at on task states with a sort key
+_UNINDEXED_DEFERRED_AT = ndb.DateTimeProperty(
+    'deferred_at', auto_now_add=True, indexed=False)
+_UNINDEXED_DEFERRED_AT._fix_up(TaskState, 'deferred_at')
+
+
 class UniqueTaskMarker(ndb.Model):
     deferred_at = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class TaskProfile(ndb.Model):
+    """
+    cProfile and RPC trace summary of one run of a task. Stored as a child of
+    the TaskState that was run.
+    """
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    request_log_id = ndb.StringProperty()
+    wall_time = ndb.FloatProperty()
+    summary = ndb.JsonProperty(compressed=True)
+
+
+class TaskDependency(ndb.Model):
+    """
+    Edge in a task graph. Stored as a child of the TaskState that must
+    complete first, with the id of the waiting TaskState as its own id, so
+    that completing a task only ever touches its own entity group.
+    """
+    deferred_at = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class DependencyCounter(ndb.Model):
+    """
+    One shard of the tally of a waiting task's dependencies that have
+    completed, with an id of "<waiting task id>:<shard>". Holds the ids of
+    the dependencies counted so far so that each is only counted once.
+    """
+    completed = ndb.IntegerProperty(repeated=True, indexed=False)
@@ -0,0 +1,138 @@
+import cProfile
+import logging
+import pstats
+import random
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+
+from . import local
+from .config import config
+from .models import TaskProfile
+
+# number of functions, by cumulative time, kept in a profile summary
+MAX_FUNCTIONS = 50
+
+# number of individual RPCs kept in a profile summary
+MAX_RPCS = 500
+
+_local = threading.local()
+_hooked_apiproxy = None
+
+
+def should_profile(task_state):
+    if task_state.deferred_function in config.PROFILE_FUNCTIONS:
+        return True
+
+    return bool(config.PROFILE_SAMPLE_RATE) and (
+        random.random() < config.PROFILE_SAMPLE_RATE)
+
+
+def profile(task_state, fn, *args, **kwargs):
+    """
+    Call `fn` under cProfile while tracing the RPCs it makes, and store a
+    summary of both as a TaskProfile of `task_state` whether or not it raises.
+    """
+    _install_hooks()
+
+    profiler = cProfile.Profile()
+    trace = _local.trace = RPCTrace()
+    start = time.time()
+
+    try:
+        return profiler.runcall(fn, *args, **kwargs)
+    finally:
+        wall_time = time.time() - start
+        _local.trace = None
+
+        try:
+            TaskProfile(
+                parent=task_state.key,
+                request_log_id=local.get_execution()['request_log_id'],
+                wall_time=wall_time,
+                summary={
+                    'functions': summarise_profile(profiler),
+                    'rpcs': trace.rpcs[:MAX_RPCS],
+                    'rpc_totals': trace.totals(),
+                }
+            ).put()
+        except Exception:
+            logging.exception("Failed to store task profile")
+
+
+def summarise_profile(profiler):
+    stats = pstats.Stats(profiler).stats
+
+    functions = [{
+            'function': pstats.func_std_string(func),
+            'calls': calls,
+            'total_time': total_time,
+            'cumulative_time': cumulative_time,
+        }
+        for func, (_, calls, total_time, cumulative_time, _) in stats.iteritems()
+    ]
+    functions.sort(key=lambda f: f['cumulative_time'], reverse=True)
+
+    return functions[:MAX_FUNCTIONS]
+
+
+class RPCTrace(object):
+    def __init__(self):
+        self.start = time.time()
+        self.rpcs = []
+        self.pending = {}
+
+    def begin(self, service, call, rpc):
+        self.pending[id(rpc)] = (service, call, time.time())
+
+    def end(self, rpc):
+        try:
+            service, call, start = self.pending.pop(id(rpc))
+        except KeyError:
+            return
+
+        self.rpcs.append({
+            'service': service,
+            'call': call,
+            'start': start - self.start,
+            'duration': time.time() - start,
+        })
+
+    def totals(self):
+        totals = {}
+        for rpc in self.rpcs:
+            total = totals.setdefault(
+                '{service}.{call}'.format(**rpc), {'count': 0, 'time': 0.0})
+            total['count'] += 1
+            total['time'] += rpc['duration']
+        return totals
+
+
+def _pre_call_hook(service, call, request, response, rpc):
+    trace = getattr(_local, 'trace', None)
+    if trace is not None:
+        trace.begin(service, call, rpc)
+
+
+def _post_call_hook(service, call, request, response, rpc):
+    trace = getattr(_local, 'trace', None)
+    if trace is not None:
+        trace.end(rpc)
+
+
+def _install_hooks():
+    """
+    Hooks are only added the first time a task is profiled, so instances
+    which never profile don't pay for them on every RPC.
+    """
+    global _hooked_apiproxy
+
+    apiproxy = apiproxy_stub_map.apiproxy
+
+    if _hooked_apiproxy is not apiproxy:
+        apiproxy.GetPreCallHooks().Append(
+            'deferred_manager_profiler', _pre_call_hook)
+        apiproxy.GetPostCallHooks().Append(
+            'deferred_manager_profiler', _post_call_hook)
+        _hooked_apiproxy = apiproxy
@@ -0,0 +1,63 @@
+"""
+Running state and attempt metadata of tasks held in memcache, used instead of
+datastore writes when `MEMCACHE_RUNNING_STATE` is enabled. Only terminal
+states are written to the datastore.
+"""
+from google.appengine.api import memcache
+
+from .config import config
+
+KEY_PREFIX = 'deferred_manager:runstate:'
+
+# how long a task is considered running for if it never reports back. Longer
+# than the 10 minute deadline of a push queue task
+RUNNING_TIME = 15 * 60
+
+# how long metadata of failed attempts is kept for between retries
+STATE_TIME = 7 * 24 * 60 * 60
+
+FIELDS = (
+    'is_running',
+    'task_name',
+    'retry_count',
+    'request_log_ids',
+    'first_run',
+)
+
+
+def get_key(task_state_id):
+    return KEY_PREFIX + str(task_state_id)
+
+
+def snapshot(task_state):
+    return {name: getattr(task_state, name) for name in FIELDS}
+
+
+def apply(task_state, state):
+    for name, value in state.iteritems():
+        setattr(task_state, name, value)
+
+
+def save(task_state):
+    """
+    Store the state of a task that has stopped running without completing
+    """
+    memcache.set(
+        get_key(task_state.key.id()), snapshot(task_state), time=STATE_TIME)
+
+
+def merge(task_states):
+    """
+    Overlay memcache state onto incomplete tasks for display. The entities
+    are not written back.
+    """
+    if not config.MEMCACHE_RUNNING_STATE:
+        return
+
+    incomplete = {
+        get_key(t.key.id()): t for t in task_states if not t.is_complete
+    }
+
+    if incomplete:
+        for key, state in memcache.get_multi(incomplete.keys()).iteritems():
+            apply(incomplete[key], state)
@@ -69,37 +69,6 @@
 
 		getTasks($scope.queue);
 
-		function getTaskStatusMsg(task) {
-			if (task.was_purged) {
-				return 'purged';
-			}
-
-			if (task.is_permanently_failed) {
-				return 'failed';
-			}
-
-			if (task.is_complete) {
-				return;
-			}
-
-			if (task.is_running) {
-				if (task.retry_count) {
-					return 'running - attempt ' + (task.retry_count + 1);
-				}
-				return 'running';
-			}
-
-			if (!task.is_complete && !task.is_permanently_failed) {
-				if (task.retry_count) {
-					return 'pending - failed ' + (task.retry_count + 1) + ' times';
-				}
-				else if (task.first_run) {
-					return 'pending - failed once';
-				}
-				return 'pending';
-			}
-		}
-
 		function purgeQueue() {
 			$http
 				.delete(appSettings.apiRootUrl + $scope.queueName)
@@ -194,13 +163,20 @@
 		this.taskId = $routeParams.taskId;
 
 		$scope.logs = [];
+		$scope.dependencies = [];
+		$scope.dependents = [];
+		$scope.profiles = [];
 		$scope.logLevels = LOG_LEVELS;
 		$scope.reRunTask = reRunTask;
+		$scope.getTaskStatusMsg = getTaskStatusMsg;
 
 		$http.get(appSettings.apiRootUrl + ctlr.queueId + '/' + ctlr.taskId)
 			.then(function(resp) {
 				$scope.task = resp.data.task;
 				$scope.logs = resp.data.logs;
+				$scope.dependencies = resp.data.dependencies;
+				$scope.dependents = resp.data.dependents;
+				$scope.profiles = resp.data.profiles;
 			});
 
 		function reRunTask(task) {
@@ -251,6 +227,41 @@
 		}
 	});
 
+	function getTaskStatusMsg(task) {
+		if (task.was_purged) {
+			return 'purged';
+		}
+
+		if (task.is_permanently_failed) {
+			return 'failed';
+		}
+
+		if (task.is_complete) {
+			return;
+		}
+
+		if (task.is_waiting) {
+			return 'waiting';
+		}
+
+		if (task.is_running) {
+			if (task.retry_count) {
+				return 'running - attempt ' + (task.retry_count + 1);
+			}
+			return 'running';
+		}
+
+		if (!task.is_complete && !task.is_permanently_failed) {
+			if (task.retry_count) {
+				return 'pending - failed ' + (task.retry_count + 1) + ' times';
+			}
+			else if (task.first_run) {
+				return 'pending - failed once';
+			}
+			return 'pending';
+		}
+	}
+
 	function extend(dst) {
 		angular.forEach(arguments, function(obj) {
 			if (obj !== dst) {
@@ -1,11 +1,17 @@
 # -*- coding: utf8 -*-
 
 import datetime
+import json
+import mock
 import os
 import unittest
 import webapp2
 
-from google.appengine.ext import testbed, deferred
+from StringIO import StringIO
+
+from google.appengine.api import memcache
+from google.appengine.api.logservice import logservice
+from google.appengine.ext import ndb, testbed, deferred
 from google.appengine.datastore import datastore_stub_util
 
 TESTCONFIG_DIR = os.path.join(
@@ -14,8 +20,13 @@ TESTCONFIG_DIR = os.path.join(
 # this needs setting before importing the wrapper
 os.environ['DEFERRED_MANAGER_ROOT_DIR'] = TESTCONFIG_DIR
 
+from . import api, cache, local, migrations, runstate
+from .config import config
+from .dependencies import register_dependencies, release_task
+from .console import application as console_application
+from .export import export_task_states
 from .handler import task_wrapper
-from .models import TaskState
+from .models import TaskState, TaskProfile
 from .utils import strip_defer_kwargs
 from .wrapper import defer
 
@@ -24,6 +35,10 @@ def noop(*args, **kwargs):
     pass
 
 
+def count_tasks(*args, **kwargs):
+    return TaskState.query().count()
+
+
 def noop_fail(*args, **kwargs):
     raise Exception
 
@@ -32,10 +47,20 @@ def noop_permanent_fail(*args, **kwargs):
     raise deferred.PermanentTaskFailure
 
 
+completed_tasks = []
+
+
+def record_completion(task_state_id):
+    completed_tasks.append(task_state_id)
+
+
 class Foo(object):
     def bar(self):
         pass
 
+    def record_completion(self, task_state_id):
+        record_completion(task_state_id)
+
     def __call__(self):
         pass
 
@@ -44,12 +69,16 @@ application = webapp2.WSGIApplication([(".*", deferred.TaskHandler)])
 
 
 class BaseTest(unittest.TestCase):
+    # chance of a non-ancestor query seeing the latest writes
+    consistency_probability = 0
+
     def setUp(self):
         self.testbed = testbed.Testbed()
 
         self.testbed.activate()
 
-        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=0)
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=self.consistency_probability)
         self.testbed.init_datastore_v3_stub(consistency_policy=policy)
         self.testbed.init_memcache_stub()
         self.testbed.init_taskqueue_stub(root_path=TESTCONFIG_DIR)
@@ -58,6 +87,11 @@ class BaseTest(unittest.TestCase):
 
         super(BaseTest, self).setUp()
 
+    def tearDown(self):
+        self.testbed.deactivate()
+
+        super(BaseTest, self).tearDown()
+
     @staticmethod
     def reload(obj):
         return obj.key.get(use_cache=False)
@@ -117,7 +151,10 @@ class DeferTaskTests(BaseTest):
             task_state.deferred_function, u"<type 'datetime.datetime'>.utcnow")
 
 
-class HandlerTests(BaseTest):
+class TaskQueueMixin(object):
+    """
+    Runs the tasks added to the taskqueue stub through the deferred handler.
+    """
     @staticmethod
     def make_request(
             queue_name,
@@ -144,6 +181,24 @@ class HandlerTests(BaseTest):
             environ=request_environ,
             **kwargs)
 
+    def run_queued_tasks(self):
+        while True:
+            tasks = [
+                (queue_name, task)
+                for queue_name in ('default', 'named-queue')
+                for task in self.taskqueue_stub.get_filtered_tasks(
+                    queue_names=[queue_name])
+            ]
+            if not tasks:
+                return
+
+            for queue_name, task in tasks:
+                self.taskqueue_stub.DeleteTask(queue_name, task.name)
+                request = self.make_request(queue_name, POST=task.payload)
+                request.get_response(application)
+
+
+class HandlerTests(TaskQueueMixin, BaseTest):
     @staticmethod
     def create_task(fn, *args, **kwargs):
         task_state = defer(fn, *args, **kwargs)
@@ -172,6 +227,29 @@ class HandlerTests(BaseTest):
         self.assertFalse(task_state.is_running)
         self.assertFalse(task_state.is_permanently_failed)
 
+    def test_completion_failure(self):
+        task_state, noop_pickle = self.create_task(
+            noop, task_reference="project1")
+
+        with mock.patch(
+                'deferred_manager.handler.notify_dependents',
+                side_effect=Exception):
+            response = self.make_request(
+                'default', POST=noop_pickle).get_response(application)
+
+        self.assertEqual(response.status_int, 500)
+
+        task_state = self.reload(task_state)
+        self.assertFalse(task_state.is_complete)
+        self.assertFalse(task_state.is_running)
+
+        # the retry is run rather than rejected as already running
+        response = self.make_request(
+            'default', POST=noop_pickle, retries=1).get_response(application)
+
+        self.assertEqual(response.status_int, 200)
+        self.assertTrue(self.reload(task_state).is_complete)
+
     def test_failure(self):
         task_state, noop_pickle = self.create_task(
             noop_fail, task_reference="project1")
@@ -250,3 +328,607 @@ class HandlerTests(BaseTest):
 
         self.assertEqual(response.status_int, 200)
 
+
+class DependencyTests(HandlerTests):
+    def test_waits_for_dependencies(self):
+        parent1 = defer(noop, task_reference="parent1")
+        parent2 = defer(noop, task_reference="parent2")
+        child = defer(
+            noop, task_reference="child", depends_on=[parent1, parent2])
+
+        self.assertTrue(child.is_waiting)
+        # the parents, and registering the child's dependencies
+        self.assertEqual(len(self.taskqueue_stub.get_filtered_tasks()), 3)
+
+        self.run_queued_tasks()
+
+        child = self.reload(child)
+        self.assertFalse(child.is_waiting)
+        self.assertTrue(child.is_complete)
+        self.assertFalse(child.is_permanently_failed)
+
+    def test_dependency_already_complete(self):
+        parent = defer(noop, task_reference="parent")
+        self.run_queued_tasks()
+
+        child = defer(noop, task_reference="child", depends_on=[parent])
+        self.assertTrue(child.is_waiting)
+
+        self.run_queued_tasks()
+
+        child = self.reload(child)
+        self.assertFalse(child.is_waiting)
+        self.assertTrue(child.is_complete)
+
+    def test_dependency_completed_elsewhere(self):
+        parent = defer(noop, task_reference="parent")
+
+        # complete the parent without updating this context's cached copy,
+        # as if it had run on another instance
+        completed = self.reload(parent)
+        completed.is_complete = True
+        completed.put(use_cache=False)
+
+        child = defer(noop, task_reference="child", depends_on=[parent])
+        register_dependencies(child.key.id())
+
+        self.assertFalse(self.reload(child).is_waiting)
+
+    def test_dependency_counted_once(self):
+        parent1 = defer(noop, task_reference="parent1")
+        parent2 = defer(noop, task_reference="parent2")
+        child = defer(
+            noop,
+            task_reference="child",
+            depends_on=[parent1, parent2, parent1])
+
+        self.assertEqual(child.dependencies, [parent1.key, parent2.key])
+
+        for parent in (parent1, parent2):
+            parent.is_complete = True
+            parent.put()
+
+            # checks may be repeated by taskqueue retries
+            release_task(child.key.id(), parent.key.id())
+            release_task(child.key.id(), parent.key.id())
+
+            if parent is parent1:
+                self.assertTrue(self.reload(child).is_waiting)
+
+        self.assertFalse(self.reload(child).is_waiting)
+
+    def test_failed_dependency(self):
+        parent = defer(noop_permanent_fail, task_reference="parent")
+        child = defer(noop, task_reference="child", depends_on=[parent])
+        grandchild = defer(
+            noop, task_reference="grandchild", depends_on=[child])
+
+        self.run_queued_tasks()
+
+        for task_state in (child, grandchild):
+            task_state = self.reload(task_state)
+            self.assertFalse(task_state.is_waiting)
+            self.assertTrue(task_state.is_complete)
+            self.assertTrue(task_state.is_permanently_failed)
+            self.assertIsNone(task_state.first_run)
+
+    def test_on_complete(self):
+        del completed_tasks[:]
+
+        task_state = defer(
+            noop, task_reference="project1", on_complete=record_completion)
+
+        self.run_queued_tasks()
+
+        self.assertEqual(completed_tasks, [task_state.key.id()])
+
+    def test_on_complete_method(self):
+        del completed_tasks[:]
+
+        task_state = defer(
+            noop, task_reference="project1", on_complete=Foo().record_completion)
+
+        self.run_queued_tasks()
+
+        self.assertEqual(completed_tasks, [task_state.key.id()])
+
+
+class PurgeTests(HandlerTests):
+    # purging finds tasks with a global query
+    consistency_probability = 1
+
+    def purge(self, queue_name):
+        request = webapp2.Request.blank(
+            '/_ah/deferredconsole/api/' + queue_name)
+        request.method = 'DELETE'
+        request.get_response(console_application)
+
+        # tasks are marked as purged by a chain of tasks
+        self.run_queued_tasks()
+
+    def test_purge_in_batches(self):
+        task_states = [defer(noop, i) for i in range(5)]
+
+        with mock.patch.object(api, 'PURGE_BATCH_SIZE', 2):
+            self.purge('default')
+
+        for task_state in task_states:
+            task_state = self.reload(task_state)
+            self.assertTrue(task_state.was_purged)
+            self.assertFalse(task_state.first_run)
+
+    def test_purge_fails_dependents(self):
+        del completed_tasks[:]
+
+        parent = defer(
+            noop, task_reference="parent", on_complete=record_completion)
+        child = defer(
+            noop,
+            task_reference="child",
+            depends_on=[parent],
+            _queue='named-queue')
+
+        self.purge('default')
+
+        self.assertTrue(self.reload(parent).was_purged)
+        self.assertEqual(completed_tasks, [parent.key.id()])
+        child = self.reload(child)
+        self.assertFalse(child.is_waiting)
+        self.assertFalse(child.was_purged)
+        self.assertTrue(child.is_permanently_failed)
+
+
+class ProfilerTests(HandlerTests):
+    def test_not_profiled(self):
+        task_state = defer(count_tasks, task_reference="project1")
+        self.run_queued_tasks()
+
+        self.assertIsNone(TaskProfile.query(ancestor=task_state.key).get())
+
+    def test_profile_function(self):
+        with mock.patch.object(
+                config, 'PROFILE_FUNCTIONS',
+                ('deferred_manager.tests.count_tasks',)):
+            task_state = defer(count_tasks, task_reference="project1")
+            self.run_queued_tasks()
+
+        profile = TaskProfile.query(ancestor=task_state.key).get()
+        self.assertTrue(profile.wall_time)
+        self.assertTrue(profile.summary['functions'])
+        self.assertIn('datastore_v3.RunQuery', profile.summary['rpc_totals'])
+        self.assertTrue(self.reload(task_state).is_complete)
+
+    def test_sample_rate(self):
+        with mock.patch.object(config, 'PROFILE_SAMPLE_RATE', 1):
+            task_state = defer(noop, task_reference="project1")
+            self.run_queued_tasks()
+
+        self.assertTrue(TaskProfile.query(ancestor=task_state.key).get())
+
+    def test_local_task_request_log(self):
+        # the request deferring the task, not the one running it
+        with mock.patch.dict(os.environ, {'REQUEST_LOG_ID': 'caller'}), \
+                mock.patch.object(config, 'PROFILE_SAMPLE_RATE', 1), \
+                mock.patch.object(config, 'EAGER', True):
+            task_state = defer(noop, task_reference="project1")
+
+        profile = TaskProfile.query(ancestor=task_state.key).get()
+        self.assertIsNone(profile.request_log_id)
+
+
+class ShardingTests(BaseTest):
+    consistency_probability = 1
+
+    def fetch_all(self, limit):
+        tasks, cursor, more = TaskState.fetch_queue_page('default', limit)
+        while more:
+            page, cursor, more = TaskState.fetch_queue_page(
+                'default', limit, cursor)
+            tasks.extend(page)
+        return tasks
+
+    def test_unsharded(self):
+        task_states = [defer(noop, i) for i in range(12)]
+
+        self.assertIsNone(task_states[0].sort_key)
+        self.assertIn(
+            'deferred_at',
+            [p.name() for p in task_states[0]._to_pb().property_list()])
+
+        tasks = self.fetch_all(5)
+
+        self.assertEqual(
+            [t.key for t in tasks],
+            [t.key for t in reversed(task_states)])
+
+    def test_sharded(self):
+        with mock.patch.object(config, 'TASK_STATE_SHARDS', 4):
+            task_states = [defer(noop, i) for i in range(25)]
+
+            self.assertTrue(all(t.shard in range(4) for t in task_states))
+
+            tasks = self.fetch_all(7)
+
+        self.assertEqual(
+            sorted(t.key.id() for t in tasks),
+            sorted(t.key.id() for t in task_states))
+        self.assertEqual(
+            [t.deferred_at for t in tasks],
+            sorted((t.deferred_at for t in tasks), reverse=True))
+
+    def test_sort_key(self):
+        with mock.patch.object(config, 'TASK_STATE_SHARDS', 4):
+            task_state = defer(noop)
+
+        self.assertEqual(
+            task_state.sort_key,
+            '{0:04d}:{1}'.format(
+                task_state.shard,
+                task_state.deferred_at.strftime('%Y-%m-%dT%H:%M:%S.%f')))
+
+        # listed by the sort key instead
+        self.assertIn(
+            'deferred_at',
+            [p.name() for p in task_state._to_pb().raw_property_list()])
+
+    def test_reshard(self):
+        # written before sharding was enabled
+        unsharded = defer(noop)
+
+        with mock.patch.object(config, 'TASK_STATE_SHARDS', 4):
+            sharded = [defer(noop, i) for i in range(10)]
+
+        with mock.patch.object(config, 'TASK_STATE_SHARDS', 2), \
+                mock.patch.object(config, 'EAGER', True):
+            # runs the chain of batches here
+            migrations.reshard_task_states(batch_size=3)
+            local.run_pending()
+
+            tasks = self.fetch_all(4)
+
+        self.assertEqual(
+            [t.key for t in tasks],
+            [t.key for t in reversed([unsharded] + sharded)])
+        self.assertTrue(all(t.shard in range(2) for t in tasks))
+
+        # and back again once sharding is disabled
+        with mock.patch.object(config, 'EAGER', True):
+            migrations.reshard_task_states(batch_size=3)
+            local.run_pending()
+
+        tasks = self.fetch_all(4)
+
+        self.assertEqual(
+            [t.key for t in tasks],
+            [t.key for t in reversed([unsharded] + sharded)])
+        self.assertTrue(all(t.sort_key is None for t in tasks))
+
+
+class MemcacheRunningStateTests(HandlerTests):
+    def setUp(self):
+        super(MemcacheRunningStateTests, self).setUp()
+
+        patcher = mock.patch.object(config, 'MEMCACHE_RUNNING_STATE', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_success(self):
+        task_state, noop_pickle = self.create_task(
+            noop, task_reference="project1")
+
+        request = self.make_request('default', POST=noop_pickle, retries=1)
+        response = request.get_response(application)
+
+        self.assertEqual(response.status_int, 200)
+
+        task_state = self.reload(task_state)
+        self.assertEqual(task_state.retry_count, 1)
+        self.assertTrue(task_state.first_run)
+        self.assertTrue(task_state.is_complete)
+        self.assertFalse(task_state.is_running)
+
+    def test_failure_not_persisted(self):
+        task_state, noop_pickle = self.create_task(
+            noop_fail, task_reference="project1")
+
+        request = self.make_request('default', POST=noop_pickle)
+        response = request.get_response(application)
+
+        self.assertEqual(response.status_int, 500)
+
+        task_state = self.reload(task_state)
+        self.assertIsNone(task_state.first_run)
+        self.assertIsNone(task_state.request_log_ids)
+
+        runstate.merge([task_state])
+        self.assertTrue(task_state.first_run)
+        self.assertTrue(task_state.request_log_ids)
+        self.assertFalse(task_state.is_running)
+
+    def test_retry_keeps_attempts(self):
+        task_state, fail_pickle = self.create_task(
+            noop_fail, task_reference="project1")
+
+        request = self.make_request('default', POST=fail_pickle)
+        request.get_response(application)
+
+        runstate.merge([task_state])
+        self.assertTrue(task_state.first_run)
+
+        request = self.make_request('default', POST=fail_pickle, retries=1)
+        request.get_response(application)
+
+        merged = self.reload(task_state)
+        runstate.merge([merged])
+        self.assertEqual(merged.first_run, task_state.first_run)
+        self.assertEqual(len(merged.request_log_ids.split(',')), 2)
+
+    def test_already_running(self):
+        task_state, noop_pickle = self.create_task(
+            noop, task_reference="project1")
+
+        task_state.is_running = True
+        memcache.set(
+            runstate.get_key(task_state.key.id()),
+            runstate.snapshot(task_state))
+
+        request = self.make_request('default', POST=noop_pickle)
+        response = request.get_response(application)
+
+        self.assertEqual(response.status_int, 200)
+        self.assertFalse(self.reload(task_state).is_complete)
+
+
+class ConsoleCacheTests(BaseTest):
+    @staticmethod
+    def console_request(path, method='GET'):
+        request = webapp2.Request.blank('/_ah/deferredconsole/api/' + path)
+        request.method = method
+        return request.get_response(console_application)
+
+    def test_complete_task_cached(self):
+        task_state = defer(noop, task_reference="project1")
+        task_state.is_complete = True
+        task_state.put()
+        cache_key = cache.task_info_key(task_state.key.id())
+
+        response = self.console_request(
+            'default/{0}'.format(task_state.key.id()))
+
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(
+            json.loads(cache.get_payload(cache_key))['task'],
+            json.loads(response.body)['task'])
+
+        # served from the cache from now on
+        task_state.key.delete()
+        response = self.console_request(
+            'default/{0}'.format(task_state.key.id()))
+        self.assertEqual(response.status_int, 200)
+
+    def test_missing_logs_not_cached(self):
+        task_state = defer(noop, task_reference="project1")
+        task_state.is_complete = True
+        task_state.request_log_ids = 'log1,log2'
+        task_state.put()
+
+        request_log = mock.Mock(
+            request_id='log1',
+            status=200,
+            finished=True,
+            start_time=1500000000,
+            end_time=1500000001,
+            app_logs=[])
+
+        # logservice hasn't caught up with the second run yet
+        with mock.patch.object(
+                logservice, 'fetch', return_value=[request_log]):
+            response = self.console_request(
+                'default/{0}'.format(task_state.key.id()))
+
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(len(json.loads(response.body)['logs']), 1)
+        self.assertIsNone(
+            cache.get_payload(cache.task_info_key(task_state.key.id())))
+
+    def test_incomplete_task_not_cached(self):
+        task_state = defer(noop, task_reference="project1")
+
+        response = self.console_request(
+            'default/{0}'.format(task_state.key.id()))
+
+        self.assertEqual(response.status_int, 200)
+        self.assertIsNone(
+            cache.get_payload(cache.task_info_key(task_state.key.id())))
+
+    def test_new_dependent_shown(self):
+        task_state = defer(noop, task_reference="project1")
+        task_state.is_complete = True
+        task_state.put()
+        cache_key = cache.task_info_key(task_state.key.id())
+
+        self.console_request('default/{0}'.format(task_state.key.id()))
+        self.assertTrue(cache.get_payload(cache_key))
+
+        child = defer(noop, task_reference="child", depends_on=[task_state])
+        register_dependencies(child.key.id())
+
+        response = self.console_request(
+            'default/{0}'.format(task_state.key.id()))
+        self.assertEqual(
+            [t['key'] for t in json.loads(response.body)['dependents']],
+            [child.key.id()])
+
+
+class ExportTests(BaseTest):
+    consistency_probability = 1
+
+    def test_ndjson(self):
+        task_states = [defer(noop, i) for i in range(5)]
+        defer(noop, _queue='named-queue')
+        out = StringIO()
+
+        count, cursor = export_task_states(
+            out, queue_name='default', fields=('key', 'deferred_args'),
+            batch_size=2)
+
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(count, 5)
+        self.assertIsNone(cursor)
+        self.assertEqual(
+            sorted(rows),
+            sorted({'key': t.key.id(), 'deferred_args': t.deferred_args}
+                   for t in task_states))
+
+    def test_csv(self):
+        task_state = defer(noop, u"b\xe5r")
+        out = StringIO()
+
+        count, _ = export_task_states(
+            out, fields=('key', 'deferred_args', 'first_run'),
+            output_format='csv')
+
+        self.assertEqual(count, 1)
+        self.assertEqual(
+            out.getvalue().splitlines(),
+            ['key,deferred_args,first_run',
+             "{0},\"(u'b\\xe5r',)\",".format(task_state.key.id())])
+
+    def test_endpoint(self):
+        defer(noop)
+        request = webapp2.Request.blank(
+            '/_ah/deferredconsole/export.ndjson?fields=key,queue_name')
+
+        response = request.get_response(console_application)
+
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(
+            sorted(json.loads(response.body)), ['key', 'queue_name'])
+
+    def test_endpoint_unknown_field(self):
+        request = webapp2.Request.blank(
+            '/_ah/deferredconsole/export.csv?fields=key,pickle')
+
+        response = request.get_response(console_application)
+
+        self.assertEqual(response.status_int, 400)
+
+    def test_endpoint_invalid_params(self):
+        for params in ('batch_size=ten', 'limit=0', 'cursor=nonsense'):
+            request = webapp2.Request.blank(
+                '/_ah/deferredconsole/export.csv?' + params)
+
+            response = request.get_response(console_application)
+
+            self.assertEqual(response.status_int, 400)
+
+    def test_endpoint_parts(self):
+        task_states = [defer(noop, i) for i in range(5)]
+
+        keys = []
+        url = '/_ah/deferredconsole/export.ndjson?fields=key&limit=2'
+        cursor = ''
+        for _ in range(3):
+            request = webapp2.Request.blank(url + '&cursor=' + cursor)
+            response = request.get_response(console_application)
+
+            keys.extend(
+                json.loads(line)['key'] for line in response.body.splitlines())
+            cursor = response.headers.get('X-Export-Cursor')
+
+            if cursor is None:
+                break
+
+        self.assertIsNone(cursor)
+        self.assertEqual(sorted(keys), sorted(t.key.id() for t in task_states))
+
+
+class EagerTests(BaseTest):
+    def setUp(self):
+        super(EagerTests, self).setUp()
+
+        patcher = mock.patch.object(config, 'EAGER', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_inline(self):
+        task_state = self.reload(defer(noop, task_reference="project1"))
+
+        self.assertTrue(task_state.is_complete)
+        self.assertFalse(task_state.is_running)
+        self.assertFalse(task_state.is_permanently_failed)
+        self.assertTrue(task_state.task_name.startswith('local-'))
+        self.assertIsNone(task_state.request_log_ids)
+        self.assertFalse(self.taskqueue_stub.get_filtered_tasks())
+
+    def test_retries_until_failed(self):
+        with mock.patch.object(deferred, 'run', wraps=deferred.run) as run:
+            task_state = defer(
+                noop_fail, task_reference="project1", _queue='named-queue')
+
+        # not run again once the wrapper has given up on it
+        self.assertEqual(run.call_count, 2)
+
+        task_state = self.reload(task_state)
+        self.assertTrue(task_state.is_complete)
+        self.assertTrue(task_state.is_permanently_failed)
+        self.assertEqual(task_state.retry_count, 1)
+
+    def test_max_attempts(self):
+        with mock.patch.object(config, 'EAGER_MAX_ATTEMPTS', 3):
+            task_state = defer(noop_fail, task_reference="project1")
+
+        task_state = self.reload(task_state)
+        self.assertTrue(task_state.is_complete)
+        self.assertTrue(task_state.is_permanently_failed)
+        self.assertEqual(task_state.retry_count, 2)
+
+    def test_waits_for_transaction(self):
+        @ndb.transactional(xg=True)
+        def defer_in_transaction():
+            return defer(noop, task_reference="project1")
+
+        task_state = defer_in_transaction()
+        self.assertFalse(self.reload(task_state).is_complete)
+
+        local.wait()
+        self.assertTrue(self.reload(task_state).is_complete)
+
+    def test_dependencies(self):
+        parent = defer(noop, task_reference="parent")
+        child = defer(noop, task_reference="child", depends_on=[parent])
+
+        self.assertTrue(self.reload(parent).is_complete)
+        self.assertTrue(self.reload(child).is_complete)
+
+    def test_thread_pool(self):
+        with mock.patch.object(config, 'EAGER_THREADS', 4):
+            task_states = [defer(count_tasks, i) for i in range(20)]
+            local.wait()
+
+        self.assertTrue(all(
+            self.reload(task_state).is_complete for task_state in task_states))
+
+
+class BenchmarkTests(unittest.TestCase):
+    def test_run(self):
+        # imported here as the benchmarks import this module
+        from . import benchmarks
+
+        results = json.loads(json.dumps(benchmarks.run(sizes=[2])))
+
+        self.assertEqual(
+            sorted(results), ['python', 'results', 'timestamp'])
+        self.assertEqual(
+            sorted((r['scenario'], r['size']) for r in results['results']),
+            [(scenario, 2) for scenario in benchmarks.Benchmarks.scenarios()])
+        for result in results['results']:
+            self.assertEqual(sorted(result), [
+                'per_task_ms',
+                'rpc_count',
+                'rpcs',
+                'rss_growth_kb',
+                'scenario',
+                'size',
+                'wall_time',
+            ])
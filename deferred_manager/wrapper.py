@@ -2,16 +2,40 @@ import logging
 
 from google.appengine.ext import ndb, deferred
 
+from . import local
+from .config import config
+from .dependencies import register_dependencies
 from .models import TaskState, UniqueTaskMarker
 from .utils import strip_defer_kwargs, get_func_repr, get_defer_kwargs
 
 
-@ndb.transactional(xg=True)
 def defer(obj, *args, **kwargs):
+    depends_on = []
+    seen = set()
+    for task_state in kwargs.pop('depends_on', None) or ():
+        key = getattr(task_state, 'key', task_state)
+        if key not in seen:
+            seen.add(key)
+            depends_on.append(key)
+
+    assert not (depends_on and ndb.in_transaction()), \
+        "tasks with dependencies cannot be deferred inside a transaction"
+
+    task_state = _defer(obj, depends_on, *args, **kwargs)
+
+    if config.EAGER and not ndb.in_transaction():
+        local.run_pending()
+
+    return task_state
+
+
+@ndb.transactional(xg=True)
+def _defer(obj, depends_on, *args, **kwargs):
     from .handler import task_wrapper
 
     unique = kwargs.pop('unique', False)
     task_reference = kwargs.pop('task_reference', None)
+    on_complete = kwargs.pop('on_complete', None)
 
     if unique:
         assert task_reference, "a task_reference must be passed"
@@ -36,17 +60,33 @@ def defer(obj, *args, **kwargs):
         task_reference=task_reference,
         unique=unique,
         queue_name=kwargs.get('_queue', 'default'),
-        pickle=pickled_obj
+        pickle=pickled_obj,
+        dependencies=depends_on,
+        is_waiting=bool(depends_on)
     )
 
+    if on_complete:
+        task_state.on_complete = deferred.serialize(on_complete)
+
     try:
         task_state.deferred_args = unicode(args)
         task_state.deferred_kwargs = unicode(strip_defer_kwargs(kwargs))
         task_state.deferred_function = get_func_repr(obj)
     except:
         pass
-    task_state.put()
 
-    task = deferred.defer(task_wrapper, task_state.key.id(), pickled_obj, task_reference, _transactional=True, **defer_kwargs)
+    if depends_on:
+        # enqueued by the last of its dependencies to complete
+        defer_kwargs.pop('_transactional', None)
+        task_state.defer_kwargs = defer_kwargs
+        task_state.put()
+        local.enqueue(
+            register_dependencies,
+            task_state.key.id(),
+            _queue=task_state.queue_name,
+            _transactional=True)
+    else:
+        task_state.put()
+        task = local.enqueue(task_wrapper, task_state.key.id(), pickled_obj, task_reference, _transactional=True, **defer_kwargs)
 
     return task_state
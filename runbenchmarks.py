@@ -0,0 +1,6 @@
+#!/usr/bin/env python
+import sys
+
+from deferred_manager import benchmarks
+
+benchmarks.main(sys.argv[1:])